@@ -45,6 +45,13 @@ def record(args):
     help="The glob patterns of domain names to enable training for. "
     "By default this will be *.domain of the given URL",
 )
+@command.argument(
+    "--stable_set_workers",
+    help="The number of page loads to run at the same time when finding the dependency stable set. "
+    "Concurrent loads compete for CPU and skew the emulated client's ordering and timings",
+    type=int,
+    default=1,
+)
 @command.command
 def preprocess(args):
     """
@@ -66,7 +73,7 @@ def preprocess(args):
     har_resources = har_entries_to_resources(capture_har_in_replay_server(args.website, config, client_env))
 
     log.info("finding dependency stable set...")
-    res_list = find_url_stable_set(args.website, config)
+    res_list = find_url_stable_set(args.website, config, max_workers=args.stable_set_workers)
 
     log.info("found total dependencies", total=len(res_list))
     push_groups = resource_list_to_push_groups(res_list, train_domain_globs=train_domain_globs)
@@ -111,10 +118,11 @@ def annotate_cacheable_objects(record_dir: str, push_groups: List[PushGroup]) ->
     and annotating the ones that are cacheable
     """
     filestore = FileStore(record_dir)
-    cache_times = {
-        **{f"http://{f.host}{f.uri}": f.cache_time for f in filestore.cacheable_files},
-        **{f"https://{f.host}{f.uri}": f.cache_time for f in filestore.cacheable_files},
-    }
+    cache_times = {}
+    for f in filestore.cacheable_files:
+        cache_times[f"http://{f.host}{f.uri}"] = f.cache_time
+        cache_times[f"https://{f.host}{f.uri}"] = f.cache_time
+
     for group in push_groups:
         for i, res in enumerate(group.resources):
             cache_time = cache_times.get(res.url, 0)
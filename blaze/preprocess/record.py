@@ -1,13 +1,18 @@
 """ This module implements utilities to record and pre-process live web page loads """
 import collections
+from concurrent import futures
 import functools
+import io
+import statistics
 import subprocess
 import sys
 import tempfile
-from typing import List, Optional, Set
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from bs4 import BeautifulSoup
+from lxml import etree
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
 
 from blaze.action import Policy
 from blaze.chrome.har import Har
@@ -18,13 +23,25 @@ from blaze.chrome.config import get_chrome_command, get_chrome_flags
 from blaze.chrome.devtools import capture_har_in_replay_server, capture_si_in_replay_server
 from blaze.logger import logger
 from blaze.mahimahi import MahiMahiConfig
-from blaze.util.seq import ordered_uniq
 
 from .har import har_entries_to_resources, compute_parent_child_relationships
 from .url import Url
 
 EXECUTION_CAPTURE_RUNS = 5
 STABLE_SET_NUM_RUNS = 10
+PAGE_LINKS_MAX_WORKERS = 8
+PAGE_LINK_PREFIXES = ("http://", "https://", "/")
+# (connect, read) timeouts in seconds and the maximum number of bytes read from each crawled page
+PAGE_FETCH_TIMEOUT = (3, 10)
+PAGE_MAX_BYTES = 2_000_000
+
+# Shared HTTP session so that get_page_links reuses keep-alive connections while crawling
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+# Crawled sites link to the same URLs from many pages, so parsed URLs are memoized
+_parse_url = functools.lru_cache(maxsize=65536)(Url.parse)
 
 
 def record_webpage(url: str, save_dir: str, config: Config):
@@ -48,92 +65,149 @@ def record_webpage(url: str, save_dir: str, config: Config):
         proc.check_returncode()
 
 
-def find_url_stable_set(url: str, config: Config) -> List[Resource]:
+def find_url_stable_set(url: str, config: Config, max_workers: int = 1) -> List[Resource]:
     """
     Loads the given URL `STABLE_SET_NUM_RUNS` times back-to-back and records the HAR file
     generated by chrome. It then finds the common URLs across the page loads, computes their
-    relative ordering, and returns a list of PushGroups for the webpage
+    relative ordering, and returns a list of PushGroups for the webpage.
+
+    Up to `max_workers` loads are run at the same time. Concurrent loads compete for the same
+    CPU cores and so no longer reflect the emulated client, which skews both the measured
+    ordering and the timings, so only raise this when speed matters more than fidelity
     """
     log = logger.with_namespace("find_url_stable_set")
-    hars: List[Har] = []
-    resource_sets: List[Set[Resource]] = []
-    pos_dict = collections.defaultdict(lambda: collections.defaultdict(int))
-    for n in range(STABLE_SET_NUM_RUNS):
+
+    def capture(n: int) -> Har:
         log.debug("capturing HAR...", run=n + 1, url=url)
-        har = capture_har_in_replay_server(url, config, get_default_client_environment())
+        return capture_har_in_replay_server(url, config, get_default_client_environment())
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        captured_hars = list(pool.map(capture, range(STABLE_SET_NUM_RUNS)))
+
+    hars: List[Har] = []
+    resource_counts = collections.Counter()
+    run_ranks: List[Dict[str, int]] = []
+    for n, har in enumerate(captured_hars):
         resource_list = har_entries_to_resources(har)
         if not resource_list:
             log.warn("no response received", run=n + 1)
             continue
         log.debug("received resources", total=len(resource_list))
 
-        for i in range(len(resource_list)):  # pylint: disable=consider-using-enumerate
-            for j in range(i + 1, len(resource_list)):
-                pos_dict[resource_list[i].url][resource_list[j].url] += 1
+        # Record the first position of each URL in this load so that relative orderings
+        # can be computed on demand instead of storing every pair of URLs
+        ranks: Dict[str, int] = {}
+        for i, res in enumerate(resource_list):
+            ranks.setdefault(res.url, i)
 
-        resource_sets.append(set(resource_list))
+        run_ranks.append(ranks)
+        resource_counts.update(set(resource_list))
         hars.append(har)
 
-    log.debug("resource set lengths", resource_lens=list(map(len, resource_sets)))
-    if not resource_sets:
+    log.debug("resource set lengths", resource_lens=[len(ranks) for ranks in run_ranks])
+    if not run_ranks:
         return []
 
-    common_res = list(set.intersection(*resource_sets))
-    common_res.sort(key=functools.cmp_to_key(lambda a, b: -pos_dict[a.url][b.url] + (len(resource_sets) // 2)))
+    # A resource is in the stable set if it was present in every successful page load
+    common_res = [res for (res, count) in resource_counts.items() if count == len(run_ranks)]
+    # Sort by the median position first: this is a plain key sort and leaves the list nearly
+    # in order, so the stable majority-vote sort below only needs about one comparison per
+    # element rather than O(N log N) comparator calls
+    common_res.sort(key=lambda r: statistics.median(ranks[r.url] for ranks in run_ranks))
+    common_res.sort(
+        key=functools.cmp_to_key(
+            lambda a, b: -sum(ranks[a.url] < ranks[b.url] for ranks in run_ranks) + (len(run_ranks) // 2)
+        )
+    )
 
     # Hackily reorder the combined resource sets so that compute_parent_child_relationships works
     common_res = [Resource(**{**r._asdict(), "order": i}) for (i, r) in enumerate(common_res)]
     return compute_parent_child_relationships(common_res, hars[0].timings)
 
 
-def get_page_links(url: str, max_depth: int = 1) -> List[str]:
+def iter_page_hrefs(page_content: bytes, encoding: Optional[str] = None) -> Iterator[Optional[str]]:
     """
-    Performs DFS with the given max_depth on the given URL to discover all
-    <a href="..."> links in the page
+    Incrementally parses the given HTML document and yields the href attribute of each
+    <a> element. Each element (and its preceding siblings) is freed as soon as it has been
+    read so that memory use does not grow with the size of the page. If no encoding is
+    given, it is detected from the document itself
     """
-    if max_depth == 0:
-        return []
+    for _, elem in etree.iterparse(io.BytesIO(page_content), tag="a", html=True, recover=True, encoding=encoding):
+        yield elem.get("href")
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
 
-    log = logger.with_namespace("get_page_links").with_context(depth_left=max_depth)
+
+def _get_same_domain_links(url: str) -> Tuple[str, ...]:
+    """
+    Fetches the given URL and returns the <a href="..."> links in the page that point
+    to the same domain. Returns an empty tuple if the page cannot be fetched or parsed
+    """
+    log = logger.with_namespace("get_page_links")
     try:
         log.info("fetching page", url=url)
-        page = requests.get(url)
-        page.raise_for_status()
-        page_text = page.text
-    except requests.exceptions.RequestException as err:
+        page = _session.get(url, stream=True, timeout=PAGE_FETCH_TIMEOUT)
+        try:
+            page.raise_for_status()
+            page_content = page.raw.read(PAGE_MAX_BYTES, decode_content=True)
+            # requests falls back to ISO-8859-1 for text/* responses without a charset, which
+            # would override a <meta charset> in the page, so only use a declared charset
+            page_encoding = page.encoding if "charset=" in page.headers.get("content-type", "").lower() else None
+        finally:
+            page.close()
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as err:
         log.warn("failed to fetch page", error=repr(err))
-        return []
+        return ()
 
     try:
-        log.debug("parsing http response", length=len(page_text))
-        root = BeautifulSoup(page_text, "html.parser")
-    except err:
-        log.verbose(page_text)
+        log.debug("parsing http response", length=len(page_content))
+        parsed_links = list(iter_page_hrefs(page_content, page_encoding))
+    except (etree.LxmlError, LookupError) as err:
+        log.verbose(page_content)
         log.warn("failed to parse response", error=repr(err))
-        return []
+        return ()
 
-    parsed_links = root.find_all("a")
     log.info("found links", url=url, n_links=len(parsed_links))
 
-    links = []
-    domain = Url.parse(url).domain
-    scheme = Url.parse(url).scheme
-    for link in parsed_links:
-        link_url = link.get("href")
-        if link_url.startswith("http"):
-            link_domain = Url.parse(link_url).domain
-            if link_domain != domain:
-                log.debug("ignoring found link (bad domain)", link=link_url)
-                continue
-        elif link_url.startswith("/"):
-            link_url = f"{scheme}://{domain}{link_url}"
-        else:
-            log.debug("ignoring found link (bad prefix)", link=link_url)
-            continue
+    page_url = _parse_url(url)
+    domain, scheme = page_url.domain, page_url.scheme
+    hrefs = [href for href in parsed_links if href and href.startswith(PAGE_LINK_PREFIXES)]
+    links = tuple(
+        f"{scheme}://{domain}{href}" if href.startswith("/") else href
+        for href in hrefs
+        if href.startswith("/") or _parse_url(href).domain == domain
+    )
+    log.debug(
+        "ignoring found links",
+        url=url,
+        n_bad_prefix=len(parsed_links) - len(hrefs),
+        n_bad_domain=len(hrefs) - len(links),
+    )
+    return links
+
 
-        links.append(link_url)
-        links.extend(get_page_links(link_url, max_depth - 1))
-    return ordered_uniq(links)
+def get_page_links(url: str, max_depth: int = 1) -> List[str]:
+    """
+    Performs BFS with the given max_depth on the given URL to discover all
+    <a href="..."> links in the page. Each unique page is fetched at most once,
+    and the pages at each depth are fetched concurrently
+    """
+    # An insertion-ordered dict serves as both the visited set and the ordered output. It is
+    # seeded with the starting URL so that it is never queued again, and that URL is dropped
+    # from the result
+    links: Dict[str, None] = {url: None}
+    frontier = [url]
+    with futures.ThreadPoolExecutor(max_workers=PAGE_LINKS_MAX_WORKERS) as pool:
+        for _ in range(max_depth):
+            next_frontier = []
+            for page_links in pool.map(_get_same_domain_links, frontier):
+                for link_url in page_links:
+                    if link_url not in links:
+                        links[link_url] = None
+                        next_frontier.append(link_url)
+            frontier = next_frontier
+    return list(links)[1:]
 
 
 def get_page_load_time_in_replay_server(
@@ -3,13 +3,14 @@ import tempfile
 import pytest
 from unittest import mock
 
-from blaze.command.preprocess import preprocess, record
+from blaze.command.preprocess import annotate_cacheable_objects, preprocess, record
 from blaze.config.client import get_default_client_environment
 from blaze.config.config import get_config
-from blaze.config.environment import EnvironmentConfig
+from blaze.config.environment import EnvironmentConfig, PushGroup, Resource, ResourceType
 from blaze.preprocess.har import har_entries_to_resources
 from blaze.preprocess.record import STABLE_SET_NUM_RUNS
 
+from blaze.mahimahi.server.filestore import File
 from tests.mocks.har import generate_har, HarReturner
 
 
@@ -86,3 +87,74 @@ class TestPreprocess:
 
         assert mock_capture_har_in_mahimahi.call_count == 1
         mock_capture_har_in_mahimahi.assert_called_with("https://cs.ucla.edu", config, client_env)
+
+    @mock.patch("blaze.command.preprocess.find_url_stable_set")
+    @mock.patch("blaze.command.preprocess.capture_har_in_replay_server")
+    def test_passes_stable_set_workers(self, mock_capture_har_in_mahimahi, mock_find_url_stable_set):
+        mock_capture_har_in_mahimahi.return_value = generate_har()
+        mock_find_url_stable_set.return_value = []
+        with tempfile.NamedTemporaryFile() as output_file:
+            with tempfile.TemporaryDirectory() as output_dir:
+                preprocess(["https://cs.ucla.edu", "--output", output_file.name, "--record_dir", output_dir])
+                assert mock_find_url_stable_set.call_args[1] == {"max_workers": 1}
+
+                args = ["--output", output_file.name, "--record_dir", output_dir, "--stable_set_workers", "4"]
+                preprocess(["https://cs.ucla.edu", *args])
+                assert mock_find_url_stable_set.call_args[1] == {"max_workers": 4}
+
+    @mock.patch("blaze.command.preprocess.capture_har_in_replay_server")
+    def test_runs_successfully_with_extract_critical_requests(self, mock_capture_har_in_mahimahi):
+        hars = [generate_har() for _ in range(STABLE_SET_NUM_RUNS + 1)]
+        critical_har = hars[0]._replace(
+            log=hars[0].log._replace(entries=[e._replace(critical=True) for e in hars[0].log.entries[:10]])
+        )
+        critical_urls = set(e.request.url for e in critical_har.log.entries)
+        mock_capture_har_in_mahimahi.side_effect = [hars[0], critical_har]
+        with tempfile.NamedTemporaryFile() as output_file:
+            with tempfile.TemporaryDirectory() as output_dir:
+                with mock.patch("blaze.preprocess.record.capture_har_in_replay_server", new=HarReturner(hars)):
+                    preprocess(
+                        [
+                            "https://cs.ucla.edu",
+                            "--output",
+                            output_file.name,
+                            "--record_dir",
+                            output_dir,
+                            "--extract_critical_requests",
+                        ]
+                    )
+
+                config = EnvironmentConfig.load_file(output_file.name)
+                resources = [res for group in config.push_groups for res in group.resources]
+                assert any(res.critical for res in resources)
+                assert all(res.url in critical_urls for res in resources if res.critical)
+                assert config.har_resources == har_entries_to_resources(hars[0])
+
+        client_env = get_default_client_environment()
+        config = get_config(EnvironmentConfig(replay_dir=output_dir, request_url="https://cs.ucla.edu"))
+
+        # har_resources come from a plain capture and critical requests from a separate one
+        assert mock_capture_har_in_mahimahi.call_args_list == [
+            mock.call("https://cs.ucla.edu", config, client_env),
+            mock.call("https://cs.ucla.edu", config, client_env, extract_critical_requests=True),
+        ]
+
+
+class TestAnnotateCacheableObjects:
+    @mock.patch("blaze.command.preprocess.FileStore")
+    def test_annotates_http_and_https_resources(self, mock_filestore):
+        file_args = {"file_path": "", "method": "GET", "host": "cs.ucla.edu", "headers": {}, "status": 200, "body": b""}
+        mock_filestore.return_value.cacheable_files = [
+            File(**file_args, uri="/a.js", cache_time=10),
+            File(**file_args, uri="/b.css", cache_time=20),
+        ]
+        resources = [
+            Resource(url="http://cs.ucla.edu/a.js", size=100, type=ResourceType.SCRIPT),
+            Resource(url="https://cs.ucla.edu/b.css", size=100, type=ResourceType.CSS),
+            Resource(url="https://cs.ucla.edu/c.png", size=100, type=ResourceType.IMAGE),
+        ]
+        push_groups = [PushGroup(id=0, name="cs.ucla.edu", resources=resources)]
+
+        push_groups = annotate_cacheable_objects("/tmp/record_dir", push_groups)
+        mock_filestore.assert_called_with("/tmp/record_dir")
+        assert [res.cache_time for res in push_groups[0].resources] == [10, 20, 0]
@@ -1,6 +1,7 @@
 import datetime
 import os
 import json
+import threading
 from types import SimpleNamespace
 
 import numpy as np
@@ -51,10 +52,12 @@ class HarReturner:
     def __init__(self, hars):
         self.hars = hars
         self.i = 0
+        self.lock = threading.Lock()
 
     def __call__(self, url, *args):
-        if self.i >= len(self.hars):
-            raise IndexError("capture_har called too many times!")
-        har = self.hars[self.i]
-        self.i += 1
+        with self.lock:
+            if self.i >= len(self.hars):
+                raise IndexError("capture_har called too many times!")
+            har = self.hars[self.i]
+            self.i += 1
         return har
@@ -1,11 +1,20 @@
 import random
 import requests
+import urllib3
 
 import pytest
 from unittest import mock
 
 
-from blaze.preprocess.record import record_webpage, find_url_stable_set, get_page_links, STABLE_SET_NUM_RUNS
+from blaze.preprocess.record import (
+    record_webpage,
+    find_url_stable_set,
+    get_page_links,
+    iter_page_hrefs,
+    PAGE_FETCH_TIMEOUT,
+    PAGE_MAX_BYTES,
+    STABLE_SET_NUM_RUNS,
+)
 from tests.mocks.config import get_config
 from tests.mocks.har import empty_har, generate_har, HarReturner
 
@@ -21,7 +30,15 @@ def exists_before(seq, a, b):
 def make_page_links(*links):
     html = """<html><body>{links}</body></html>"""
     link = """<a href="{}" />"""
-    return html.format(links="".join(map(link.format, links)))
+    return html.format(links="".join(map(link.format, links))).encode()
+
+
+def make_response(content, headers=None, encoding=None):
+    response = mock.Mock()
+    response.raw.read.return_value = content
+    response.headers = headers or {}
+    response.encoding = encoding
+    return response
 
 
 class TestRecordWebpage:
@@ -63,6 +80,17 @@ class TestFindUrlStableSet:
             stable_set = find_url_stable_set("http://cs.ucla.edu", self.config)
         assert stable_set
 
+    def test_find_url_stable_set_with_multiple_workers(self):
+        hars = [generate_har() for _ in range(STABLE_SET_NUM_RUNS)]
+        har_urls = [[e.request.url for e in har.log.entries] for har in hars]
+        with mock.patch(
+            "blaze.preprocess.record.capture_har_in_replay_server", new=HarReturner(hars)
+        ) as mock_capture_har:
+            stable_set = find_url_stable_set("http://cs.ucla.edu", self.config, max_workers=4)
+        assert mock_capture_har.i == STABLE_SET_NUM_RUNS
+        assert stable_set
+        assert all(all(res.url in har for har in har_urls) for res in stable_set)
+
     def test_find_url_stable_set(self):
         hars = [generate_har() for _ in range(STABLE_SET_NUM_RUNS)]
         har_urls = [[e.request.url for e in har.log.entries] for har in hars]
@@ -85,81 +113,151 @@ class TestFindUrlStableSet:
                 assert total >= len(hars) // 2
 
 
+class TestIterPageHrefs:
+    def test_yields_hrefs_in_order(self):
+        hrefs = ["http://cs.ucla.edu/a", "/b", "c"]
+        assert list(iter_page_hrefs(make_page_links(*hrefs))) == hrefs
+
+    def test_yields_nested_hrefs(self):
+        html = b"""<html><body><div><p><a href="/a">a</a></p></div><a href="/b">b</a></body></html>"""
+        assert list(iter_page_hrefs(html)) == ["/a", "/b"]
+
+    def test_decodes_with_given_encoding(self):
+        html = """<html><body><a href="/café">café</a></body></html>""".encode()
+        assert list(iter_page_hrefs(html, "utf-8")) == ["/café"]
+        assert list(iter_page_hrefs("""<a href="/café">""".encode("latin-1"), "iso-8859-1")) == ["/café"]
+
+    def test_tolerates_malformed_html(self):
+        html = b"""<html><body><div><a href="/a">a<p><a href="/b"></body>"""
+        assert sorted(iter_page_hrefs(html)) == ["/a", "/b"]
+
+
 class TestGetPageLinks:
     def test_returns_empty_array_when_max_depth_reached(self):
         url = "http://cs.ucla.edu"
         links = get_page_links(url, max_depth=0)
         assert not links
 
-    @mock.patch("requests.get")
+    @mock.patch("blaze.preprocess.record._session.get")
     def test_returns_empty_if_request_status_not_200(self, mock_get):
         mock_get.return_value.raise_for_status.side_effect = requests.exceptions.RequestException()
         url = "http://cs.ucla.edu"
         links = get_page_links(url)
         assert not links
 
-    @mock.patch("requests.get")
+    @mock.patch("blaze.preprocess.record._session.get")
     def test_returns_empty_if_request_fails(self, mock_get):
         mock_get.side_effect = requests.exceptions.RequestException()
         url = "http://cs.ucla.edu"
         links = get_page_links(url)
         assert not links
 
-    @mock.patch("requests.get")
+    @mock.patch("blaze.preprocess.record._session.get")
+    def test_returns_empty_if_reading_response_fails(self, mock_get):
+        mock_get.return_value.raw.read.side_effect = urllib3.exceptions.ReadTimeoutError(None, None, "timed out")
+        url = "http://cs.ucla.edu"
+        links = get_page_links(url)
+        assert not links
+        assert mock_get.return_value.close.called
+
+    @mock.patch("blaze.preprocess.record._session.get")
+    def test_refetches_page_after_failure(self, mock_get):
+        url = "http://cs.ucla.edu"
+        mock_get.side_effect = requests.exceptions.ConnectionError()
+        assert not get_page_links(url)
+
+        mock_get.side_effect = None
+        mock_get.return_value = make_response(make_page_links("http://cs.ucla.edu/a"))
+        assert get_page_links(url) == ["http://cs.ucla.edu/a"]
+        assert mock_get.call_count == 2
+
+    @mock.patch("blaze.preprocess.record._session.get")
     def test_raises_if_nonrequest_related_exception_occurs(self, mock_get):
         mock_get.side_effect = RuntimeError()
         url = "http://cs.ucla.edu"
         with pytest.raises(RuntimeError):
             get_page_links(url)
 
-    @mock.patch("requests.get")
+    @mock.patch("blaze.preprocess.record._session.get")
     def test_returns_empty_if_empty_html_received(self, mock_get):
-        mock_get.return_value.text = ""
+        mock_get.return_value = make_response(b"")
         url = "http://cs.ucla.edu"
         links = get_page_links(url)
         assert not links
 
-    @mock.patch("requests.get")
+    @mock.patch("blaze.preprocess.record._session.get")
     def test_returns_empty_if_invalid_html_received(self, mock_get):
-        mock_get.return_value.text = "<html><body></html>"
+        mock_get.return_value = make_response(b"<html><body></html>")
         url = "http://cs.ucla.edu"
         links = get_page_links(url)
         assert not links
 
-    @mock.patch("requests.get")
+    @mock.patch("blaze.preprocess.record._session.get")
     def test_returns_unique_links_in_order(self, mock_get):
         http_links = ["http://cs.ucla.edu/a", "http://cs.ucla.edu/b", "http://cs.ucla.edu/c"]
         html = make_page_links(*http_links, *http_links, *http_links)
-        mock_get.return_value.text = html
+        mock_get.return_value = make_response(html)
         url = "http://cs.ucla.edu"
         links = get_page_links(url)
         assert links == http_links
 
-    @mock.patch("requests.get")
+    @mock.patch("blaze.preprocess.record._session.get")
+    def test_uses_charset_from_content_type_header(self, mock_get):
+        mock_get.return_value = make_response(
+            make_page_links("http://cs.ucla.edu/café"),
+            headers={"content-type": "text/html; charset=utf-8"},
+            encoding="utf-8",
+        )
+        url = "http://cs.ucla.edu"
+        links = get_page_links(url)
+        assert links == ["http://cs.ucla.edu/café"]
+
+    @mock.patch("blaze.preprocess.record._session.get")
     def test_ignores_non_http_links(self, mock_get):
         http_links = ["http://cs.ucla.edu/a", "http://cs.ucla.edu/b", "http://cs.ucla.edu/c"]
         non_http_links = [
             "ftp://b.com/test",
             "rss://a/feed",
+            "httpd-setup.html",
+            "https:foo",
             "data:image/gif;base64,R0lGODlhEAAJAIAAAP///wAAACH5BAEAAAAALAAAAAAQAAkAAAIKhI+py+0Po5yUFQA7",
         ]
         html = make_page_links(*http_links, *non_http_links)
-        mock_get.return_value.text = html
+        mock_get.return_value = make_response(html)
+        url = "http://cs.ucla.edu"
+        links = get_page_links(url)
+        assert links == http_links
+
+    @mock.patch("blaze.preprocess.record._session.get")
+    def test_ignores_links_without_href(self, mock_get):
+        http_links = ["http://cs.ucla.edu/a", "http://cs.ucla.edu/b"]
+        html = b"""<html><body><a name="top">top</a><a href="">empty</a>""" + make_page_links(*http_links)
+        mock_get.return_value = make_response(html)
         url = "http://cs.ucla.edu"
         links = get_page_links(url)
         assert links == http_links
 
-    @mock.patch("requests.get")
+    @mock.patch("blaze.preprocess.record._session.get")
     def test_ignores_links_to_another_domain(self, mock_get):
         ucla_links = ["http://cs.ucla.edu/a", "http://cs.ucla.edu/b", "http://cs.ucla.edu/c"]
         non_ucla_links = ["http://ucla.edu", "http://seas.ucla.edu", "http://stanford.edu"]
         html = make_page_links(*ucla_links, *non_ucla_links)
-        mock_get.return_value.text = html
+        mock_get.return_value = make_response(html)
         url = "http://cs.ucla.edu"
         links = get_page_links(url)
         assert links == ucla_links
 
-    @mock.patch("requests.get")
+    @mock.patch("blaze.preprocess.record._session.get")
+    def test_reads_limited_stream_and_closes_response(self, mock_get):
+        mock_get.return_value = make_response(make_page_links("http://cs.ucla.edu/a"))
+        url = "http://cs.ucla.edu"
+        links = get_page_links(url)
+        assert links == ["http://cs.ucla.edu/a"]
+        mock_get.assert_called_with(url, stream=True, timeout=PAGE_FETCH_TIMEOUT)
+        mock_get.return_value.raw.read.assert_called_with(PAGE_MAX_BYTES, decode_content=True)
+        assert mock_get.return_value.close.called
+
+    @mock.patch("blaze.preprocess.record._session.get")
     def test_recursively_finds_http_links(self, mock_get):
         links_1 = ["http://cs.ucla.edu/a", "http://cs.ucla.edu/b", "http://cs.ucla.edu/c"]
         links_2 = ["http://cs.ucla.edu/d", "http://cs.ucla.edu/e", "http://cs.ucla.edu/f"]
@@ -167,8 +265,37 @@ class TestGetPageLinks:
         links_4 = ["http://cs.ucla.edu/j", "http://cs.ucla.edu/k", "http://cs.ucla.edu/l"]
         all_links = (links_1, links_2, links_3, links_4)
         all_htmls = [make_page_links(*links) for links in all_links]
-        type(mock_get.return_value).text = mock.PropertyMock(side_effect=all_htmls)
+        mock_get.side_effect = [make_response(html) for html in all_htmls]
         url = "http://cs.ucla.edu"
         links = get_page_links(url, max_depth=2)
         assert len(links) == sum(map(len, all_links))
         assert set(links) == set(sum(all_links, []))
+
+    @mock.patch("blaze.preprocess.record._session.get")
+    def test_fetches_each_page_once(self, mock_get):
+        shared_link = "http://cs.ucla.edu/shared"
+        links_1 = ["http://cs.ucla.edu/a", "http://cs.ucla.edu/b"]
+        htmls = {
+            "http://cs.ucla.edu": make_page_links(*links_1),
+            "http://cs.ucla.edu/a": make_page_links(shared_link),
+            "http://cs.ucla.edu/b": make_page_links(shared_link),
+            shared_link: make_page_links(),
+        }
+        mock_get.side_effect = lambda url, **kwargs: make_response(htmls[url])
+        url = "http://cs.ucla.edu"
+        links = get_page_links(url, max_depth=3)
+        assert links == ["http://cs.ucla.edu/a", "http://cs.ucla.edu/b", shared_link]
+        assert sorted(call[0][0] for call in mock_get.call_args_list) == sorted(htmls)
+
+    @mock.patch("blaze.preprocess.record._session.get")
+    def test_does_not_refetch_linked_back_pages(self, mock_get):
+        url = "http://cs.ucla.edu"
+        htmls = {
+            url: make_page_links("http://cs.ucla.edu/a"),
+            "http://cs.ucla.edu/a": make_page_links(url, "http://cs.ucla.edu/b"),
+            "http://cs.ucla.edu/b": make_page_links(url, "http://cs.ucla.edu/a"),
+        }
+        mock_get.side_effect = lambda url, **kwargs: make_response(htmls[url])
+        links = get_page_links(url, max_depth=5)
+        assert links == ["http://cs.ucla.edu/a", "http://cs.ucla.edu/b"]
+        assert mock_get.call_count == len(htmls)